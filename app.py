@@ -1,75 +1,123 @@
 # app.py
-from flask import Flask, request, jsonify, render_template
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    current_app,
+    request,
+    jsonify,
+    render_template,
+)
+import base64
+import json
 import os
 from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+from db import StorageError, StorageUnavailableError, get_store
+import rate_limit
 
-load_dotenv()
+bp = Blueprint("documents", __name__)
 
-app = Flask(__name__)
 
-# Database connection parameters
-DB_HOST = os.environ.get("DB_HOST")
-DB_NAME = os.environ.get("DB_NAME")
-DB_USER = os.environ.get("DB_USER")
-DB_PASS = os.environ.get("DB_PASS")
+def env_flag(name, default):
+    return os.environ.get(name, default).lower() in ("1", "true", "yes")
 
 
-def get_db_connection():
-    return psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS,
-        sslmode="require",  # Add this for Azure PostgreSQL
-    )
+"""
+This function creates and configures the app.
 
+Nothing here connects to the database: the document store is created and the
+schema checked by the first request that needs them.
 
-# Create the table if it doesn't exist
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS documents (
-            document_id SERIAL PRIMARY KEY,
-            filename VARCHAR(250) NOT NULL,
-            file_type VARCHAR(50) NOT NULL,
-            image BYTEA NOT NULL,  
-            datetime_uploaded TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            property_id VARCHAR(50) NOT NULL,
-            buyer_id VARCHAR(50),
-            seller_id VARCHAR(50),
-            uploaded_by VARCHAR(50) CHECK (uploaded_by IN ('buyer', 'seller')),
-            document_tag VARCHAR(50) NOT NULL
-        )
-    """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS documents_buyer (
-            document_id SERIAL PRIMARY KEY,
-            filename VARCHAR(250) NOT NULL,
-            file_type VARCHAR(50) NOT NULL,
-            image BYTEA NOT NULL,  
-            datetime_uploaded TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            buyer_id VARCHAR(50),
-            document_tag VARCHAR(50) NOT NULL
-        )
-    """
+It takes the following parameters:
+- test_config: Config values that override the environment (optional)
+
+It returns the following:
+- The Flask app
+"""
+
+
+def create_app(test_config=None):
+    load_dotenv()
+
+    app = Flask(__name__)
+    app.config.from_mapping(
+        # Database backend, "postgres" or "sqlite" for tests and benchmarks
+        DB_BACKEND=os.environ.get("DB_BACKEND", "postgres"),
+        SQLITE_PATH=os.environ.get("SQLITE_PATH", ":memory:"),
+        # Database connection parameters
+        DB_HOST=os.environ.get("DB_HOST"),
+        DB_NAME=os.environ.get("DB_NAME"),
+        DB_USER=os.environ.get("DB_USER"),
+        DB_PASS=os.environ.get("DB_PASS"),
+        DB_POOL_MIN_CONN=int(os.environ.get("DB_POOL_MIN_CONN", 1)),
+        DB_POOL_MAX_CONN=int(os.environ.get("DB_POOL_MAX_CONN", 10)),
+        DB_POOL_TIMEOUT=float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+        DB_INIT_SCHEMA=env_flag("DB_INIT_SCHEMA", "true"),
+        # Post-upload processing
+        MAX_IMAGE_DIMENSION=int(os.environ.get("MAX_IMAGE_DIMENSION", 4096)),
+        KEEP_ORIGINAL_UPLOADS=env_flag("KEEP_ORIGINAL_UPLOADS", "true"),
+        PROCESSING_WORKERS=int(os.environ.get("PROCESSING_WORKERS", 2)),
+        PROCESSING_QUEUE_SIZE=int(os.environ.get("PROCESSING_QUEUE_SIZE", 100)),
+        # Rate limiting and admission control
+        RATE_LIMITS=os.environ.get("RATE_LIMITS", ""),
+        # Defaults to the pool size so admitted requests don't wait on connections
+        MAX_CONCURRENT_REQUESTS=int(
+            os.environ.get(
+                "MAX_CONCURRENT_REQUESTS", os.environ.get("DB_POOL_MAX_CONN", 10)
+            )
+        ),
+        MAX_INFLIGHT_UPLOAD_BYTES=int(
+            os.environ.get("MAX_INFLIGHT_UPLOAD_BYTES", 200 * 1024 * 1024)
+        ),
+        OVERLOAD_RETRY_AFTER=int(os.environ.get("OVERLOAD_RETRY_AFTER", 1)),
+        # Largest single upload, Flask rejects bigger request bodies with 413
+        MAX_CONTENT_LENGTH=int(os.environ.get("MAX_UPLOAD_BYTES", 50 * 1024 * 1024)),
+        # Number of trusted proxies in front of the app setting X-Forwarded-For,
+        # 0 to rate limit on the connecting address
+        PROXY_FIX_X_FOR=int(os.environ.get("PROXY_FIX_X_FOR", 0)),
+        # Change event feed
+        EVENTS_MAX_TIMEOUT=int(os.environ.get("EVENTS_MAX_TIMEOUT", 60)),
+        EVENTS_KEEPALIVE=int(os.environ.get("EVENTS_KEEPALIVE", 15)),
+        MAX_SUBSCRIBERS=int(os.environ.get("MAX_SUBSCRIBERS", 8)),
+        MAX_SUBSCRIBERS_PER_CLIENT=int(os.environ.get("MAX_SUBSCRIBERS_PER_CLIENT", 2)),
+        # Events older than this many seconds are deleted, 0 keeps them forever
+        EVENTS_RETENTION=int(os.environ.get("EVENTS_RETENTION", 7 * 24 * 60 * 60)),
     )
-    conn.commit()
-    cur.close()
-    conn.close()
+    if test_config is not None:
+        app.config.update(test_config)
+
+    if app.config["PROXY_FIX_X_FOR"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_FIX_X_FOR"])
+
+    rate_limit.init_app(app)
+    app.register_blueprint(bp)
+    return app
+
 
+def schedule_processing(table, document_id):
+    # Deferred so image and PDF handling are only loaded once something is uploaded
+    import processing
 
-# UNCOMMENT TO INITIALIZE THE DATABASE
-# with app.app_context():
-#     init_db()
+    app = current_app._get_current_object()
+    # The first upload in each worker also queues documents a previous worker
+    # stored but didn't get to process
+    if not app.extensions.get("processing_resumed"):
+        app.extensions["processing_resumed"] = True
+        processing.schedule_pending(app)
+    return processing.schedule_processing(app, table, document_id)
 
 
-@app.route("/")
+def storage_error_response(e):
+    # Running out of connections is overload, not a bad request
+    if isinstance(e, StorageUnavailableError):
+        return rate_limit.limit_response(
+            str(e), 503, current_app.config["OVERLOAD_RETRY_AFTER"]
+        )
+    return jsonify({"error": str(e)}), 400
+
+
+@bp.route("/")
 def route():
     return render_template("api_documentation.html")
 
@@ -88,7 +136,7 @@ It returns the following:
 """
 
 
-@app.route("/documents", methods=["POST"])
+@bp.route("/documents", methods=["POST"])
 def add_document():
     print("Received request")
     print(f"Files: {request.files}")
@@ -102,43 +150,33 @@ def add_document():
         return response
 
     file = files.get("file")
-    file_type = file.content_type
+    file_type = declared_content_type(file)
     file_data = file.read()
 
-    conn = get_db_connection()
-    cur = conn.cursor()
     try:
-        cur.execute(
-            """
-            INSERT INTO documents 
-            (filename, file_type, image, property_id, buyer_id, seller_id, uploaded_by, document_tag)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING document_id
-            """,
-            (
-                file.filename,
-                file_type,
-                psycopg2.Binary(file_data),  # Convert to binary
-                data["property_id"],
-                data.get("buyer_id"),
-                data.get("seller_id"),
-                data["uploaded_by"],
-                data["document_tag"],
-            ),
+        document_id = get_store().insert_document(
+            "documents",
+            {
+                "filename": file.filename,
+                "file_type": file_type,
+                "image": file_data,
+                "property_id": data["property_id"],
+                "buyer_id": data.get("buyer_id"),
+                "seller_id": data.get("seller_id"),
+                "uploaded_by": data["uploaded_by"],
+                "document_tag": data["document_tag"],
+            },
         )
-        document_id = cur.fetchone()[0]
-        conn.commit()
+        # The bytes are stored, sniffing and normalization happen in the background
+        schedule_processing("documents", document_id)
         return (
             jsonify(
                 {"message": "Document added successfully", "document_id": document_id}
             ),
             201,
         )
-    except psycopg2.Error as e:
-        return jsonify({"error": str(e)}), 400
-    finally:
-        cur.close()
-        conn.close()
+    except StorageError as e:
+        return storage_error_response(e)
 
 
 """
@@ -157,7 +195,7 @@ It returns the following:
 """
 
 
-@app.route("/documents/buyer", methods=["POST"])
+@bp.route("/documents/buyer", methods=["POST"])
 def add_document_buyer():
     print("Received request")
     print(f"Files: {request.files}")
@@ -171,40 +209,38 @@ def add_document_buyer():
         return response
 
     file = files.get("file")
-    file_type = file.content_type
+    file_type = declared_content_type(file)
     file_data = file.read()
 
-    conn = get_db_connection()
-    cur = conn.cursor()
     try:
-        cur.execute(
-            """
-            INSERT INTO documents_buyer 
-            (filename, file_type, image, buyer_id, document_tag)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING document_id
-            """,
-            (
-                file.filename,
-                file_type,
-                psycopg2.Binary(file_data),  # Convert to binary
-                data.get("buyer_id"),
-                data["document_tag"],
-            ),
+        document_id = get_store().insert_document(
+            "documents_buyer",
+            {
+                "filename": file.filename,
+                "file_type": file_type,
+                "image": file_data,
+                "buyer_id": data.get("buyer_id"),
+                "document_tag": data["document_tag"],
+            },
         )
-        document_id = cur.fetchone()[0]
-        conn.commit()
+        # The bytes are stored, sniffing and normalization happen in the background
+        schedule_processing("documents_buyer", document_id)
         return (
             jsonify(
                 {"message": "Document added successfully", "document_id": document_id}
             ),
             201,
         )
-    except psycopg2.Error as e:
-        return jsonify({"error": str(e)}), 400
-    finally:
-        cur.close()
-        conn.close()
+    except StorageError as e:
+        return storage_error_response(e)
+
+
+def declared_content_type(file):
+    # The client's type is stored as is, processing replaces it with the sniffed one
+    file_type = file.content_type
+    if not file_type or file_type == "None":  # Handle string 'None'
+        return "application/octet-stream"
+    return file_type
 
 
 def check_mandatory_paramters(files, data, buyer=False):
@@ -217,11 +253,6 @@ def check_mandatory_paramters(files, data, buyer=False):
         print("Empty filename")
         return False, (jsonify({"error": "No file selected"}), 400)
 
-    # Get content type or default to octet-stream
-    file_type = file.content_type or "application/octet-stream"
-    if file_type == "None":  # Handle string 'None'
-        file_type = "application/octet-stream"
-
     if not buyer:
         required_fields = [
             "property_id",
@@ -273,6 +304,16 @@ def check_mandatory_paramters(files, data, buyer=False):
     return True, None
 
 
+def serialize_documents(documents):
+    # Convert datetime objects to string for JSON serialization
+    for doc in documents:
+        doc["datetime_uploaded"] = doc["datetime_uploaded"].isoformat()
+        # Add content type for frontend handling
+        image_data = base64.b64encode(doc.pop("image")).decode("ascii")
+        doc["image_url"] = f"data:{doc['file_type']};base64,{image_data}"
+    return documents
+
+
 """
 This function queries the main documents table.
 
@@ -289,7 +330,7 @@ It returns the following:
 """
 
 
-@app.route("/documents/query", methods=["GET"])
+@bp.route("/documents/query", methods=["GET"])
 def query_documents():
     # Get query parameters
     uploaded_by = request.args.get("uploaded_by")
@@ -298,58 +339,27 @@ def query_documents():
     seller_id = request.args.get("seller_id")
     document_tag = request.args.get("document_tag")
 
-    # Build query conditions
-    conditions = []
-    params = []
+    # Build query filters
+    filters = {}
 
     if uploaded_by:
-        conditions.append("uploaded_by = %s")
-        params.append(uploaded_by)
+        filters["uploaded_by"] = uploaded_by
     if property_id:
-        conditions.append("property_id = %s")
-        params.append(property_id)
+        filters["property_id"] = property_id
     if buyer_id:
-        conditions.append("buyer_id = %s")
-        params.append(buyer_id)
+        filters["buyer_id"] = buyer_id
     if seller_id:
-        conditions.append("seller_id = %s")
-        params.append(seller_id)
+        filters["seller_id"] = seller_id
     if document_tag:
-        conditions.append("document_tag = %s")
-        params.append(document_tag)
+        filters["document_tag"] = document_tag
 
-    # Construct the WHERE clause
-    where_clause = " AND ".join(conditions) if conditions else "TRUE"
-
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        query = f"""
-            SELECT document_id, filename, file_type, 
-                   encode(image, 'base64') as image_data,
-                   datetime_uploaded, 
-                   property_id, buyer_id, seller_id, 
-                   uploaded_by, document_tag
-            FROM documents
-            WHERE {where_clause}
-            ORDER BY datetime_uploaded DESC
-        """
-        cur.execute(query, params)
-        documents = cur.fetchall()
-
-        # Convert datetime objects to string for JSON serialization
-        for doc in documents:
-            doc["datetime_uploaded"] = doc["datetime_uploaded"].isoformat()
-            # Add content type for frontend handling
-            doc["image_url"] = f"data:{doc['file_type']};base64,{doc['image_data']}"
-            del doc["image_data"]  # Remove raw base64 data from response
-
-        return jsonify({"count": len(documents), "documents": documents})
-    except psycopg2.Error as e:
-        return jsonify({"error": str(e)}), 400
-    finally:
-        cur.close()
-        conn.close()
+        documents = get_store().query_documents("documents", filters)
+        return jsonify(
+            {"count": len(documents), "documents": serialize_documents(documents)}
+        )
+    except StorageError as e:
+        return storage_error_response(e)
 
 
 """
@@ -365,60 +375,31 @@ It returns the following:
 """
 
 
-@app.route("/documents/query/buyer", methods=["GET"])
+@bp.route("/documents/query/buyer", methods=["GET"])
 def query_documents_buyer():
     # Get query parameters
     buyer_id = request.args.get("buyer_id", None)
     document_tag = request.args.get("document_tag", None)
 
-    # Build query conditions
-    conditions = []
-    params = []
-
     if not buyer_id:
         return jsonify({"error": "buyer_id is required"}), 400
 
-    conditions.append("buyer_id = %s")
-    params.append(buyer_id)
+    # Build query filters
+    filters = {"buyer_id": buyer_id}
 
     if document_tag:
-        conditions.append("document_tag = %s")
-        params.append(document_tag)
-
-    # Construct the WHERE clause
-    where_clause = " AND ".join(conditions) if conditions else "TRUE"
+        filters["document_tag"] = document_tag
 
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        query = f"""
-            SELECT document_id, filename, file_type, 
-                   encode(image, 'base64') as image_data,
-                   datetime_uploaded, 
-                   buyer_id, document_tag
-            FROM documents_buyer
-            WHERE {where_clause}
-            ORDER BY datetime_uploaded DESC
-        """
-        cur.execute(query, params)
-        documents = cur.fetchall()
-
-        # Convert datetime objects to string for JSON serialization
-        for doc in documents:
-            doc["datetime_uploaded"] = doc["datetime_uploaded"].isoformat()
-            # Add content type for frontend handling
-            doc["image_url"] = f"data:{doc['file_type']};base64,{doc['image_data']}"
-            del doc["image_data"]  # Remove raw base64 data from response
-
-        return jsonify({"count": len(documents), "documents": documents})
-    except psycopg2.Error as e:
-        return jsonify({"error": str(e)}), 400
-    finally:
-        cur.close()
-        conn.close()
+        documents = get_store().query_documents("documents_buyer", filters)
+        return jsonify(
+            {"count": len(documents), "documents": serialize_documents(documents)}
+        )
+    except StorageError as e:
+        return storage_error_response(e)
 
 
-@app.route("/documents/delete", methods=["DELETE"])
+@bp.route("/documents/delete", methods=["DELETE"])
 def delete_document():
     # We need property id, uploaded by, document tag, buyer id
     property_id = request.args.get("property_id")
@@ -450,44 +431,24 @@ def delete_document():
     if document_tag not in valid_tags:
         return jsonify({"error": "Invalid document tag"}), 400
 
-    # Build query conditions
-    conditions = []
-    params = []
-
-    conditions.append("uploaded_by = %s")
-    params.append(uploaded_by)
-
-    conditions.append("property_id = %s")
-    params.append(property_id)
-
-    conditions.append("document_tag = %s")
-    params.append(document_tag)
+    # Build query filters
+    filters = {
+        "uploaded_by": uploaded_by,
+        "property_id": property_id,
+        "document_tag": document_tag,
+    }
 
     if uploaded_by == "buyer":
-        conditions.append("buyer_id = %s")
-        params.append(buyer_id)
+        filters["buyer_id"] = buyer_id
 
-    # Construct the WHERE clause
-    where_clause = " AND ".join(conditions) if conditions else "FALSE"
-
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        query = f"""
-            DELETE FROM documents
-            WHERE {where_clause}
-        """
-        cur.execute(query, params)
-        conn.commit()
+        get_store().delete_documents("documents", filters)
         return jsonify({"message": "Document deleted successfully"}), 200
-    except psycopg2.Error as e:
-        return jsonify({"error": str(e)}), 400
-    finally:
-        cur.close()
-        conn.close()
+    except StorageError as e:
+        return storage_error_response(e)
 
 
-@app.route("/documents/buyer/delete", methods=["DELETE", "GET"])
+@bp.route("/documents/buyer/delete", methods=["DELETE", "GET"])
 def delete_document_buyer():
     # We need buyer id, document tag
     document_tag = request.args.get("document_tag")
@@ -501,36 +462,133 @@ def delete_document_buyer():
     if document_tag not in valid_tags:
         return jsonify({"error": "Invalid document tag"}), 400
 
-    # Build query conditions
-    conditions = []
-    params = []
+    # Build query filters
+    filters = {"document_tag": document_tag, "buyer_id": buyer_id}
+
+    try:
+        get_store().delete_documents("documents_buyer", filters)
+        return jsonify({"message": "Document deleted successfully"}), 200
+    except StorageError as e:
+        return storage_error_response(e)
 
-    conditions.append("document_tag = %s")
-    params.append(document_tag)
 
-    conditions.append("buyer_id = %s")
-    params.append(buyer_id)
+def serialize_events(events):
+    for event in events:
+        event["created_at"] = event["created_at"].isoformat()
+    return events
 
-    # Construct the WHERE clause
-    where_clause = " AND ".join(conditions) if conditions else "FALSE"
 
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+def int_arg(value, name, default, maximum):
+    if value is None or value == "":
+        return min(default, maximum)
     try:
-        query = f"""
-            DELETE FROM documents_buyer
-            WHERE {where_clause}
-        """
-        cur.execute(query, params)
-        conn.commit()
-        return jsonify({"message": "Document deleted successfully"}), 200
-    except psycopg2.Error as e:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+    if value < 0:
+        raise ValueError(f"{name} must not be negative")
+    return min(value, maximum)
+
+
+"""
+This function returns change events for the documents and documents_buyer tables.
+
+Every insert and delete is recorded as an event. If there are no events after
+the cursor yet, the request waits (long-polls) until one arrives or the timeout
+passes. Events are kept for EVENTS_RETENTION seconds, a cursor older than that
+restarts from the oldest event that is left.
+
+It takes the following parameters:
+- after: The cursor returned by the previous call, 0 to start from the oldest event (optional)
+- limit: The largest number of events to return, at most 1000 (optional)
+- timeout: How long to wait for an event in seconds, 0 to return at once (optional)
+
+It returns the following:
+- A list of events
+- The number of events in the list
+- The cursor to pass as after in the next call
+"""
+
+
+@bp.route("/documents/events", methods=["GET"])
+def document_events():
+    try:
+        after = int_arg(request.args.get("after"), "after", 0, 2**63 - 1)
+        limit = int_arg(request.args.get("limit"), "limit", 100, 1000)
+        max_timeout = current_app.config["EVENTS_MAX_TIMEOUT"]
+        timeout = int_arg(request.args.get("timeout"), "timeout", 25, max_timeout)
+    except ValueError as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        cur.close()
-        conn.close()
+
+    try:
+        events = get_store().wait_for_events(after, max(limit, 1), timeout)
+    except StorageError as e:
+        return storage_error_response(e)
+
+    cursor = events[-1]["event_id"] if events else after
+    return jsonify(
+        {"count": len(events), "events": serialize_events(events), "cursor": cursor}
+    )
+
+
+"""
+This function streams change events as Server-Sent Events.
+
+Each event's id is its cursor, so an EventSource that reconnects resumes from
+the last event it received via the Last-Event-ID header.
+
+It takes the following parameters:
+- after: The cursor to start after, 0 for the oldest event (optional, Last-Event-ID takes precedence)
+
+It returns the following:
+- A text/event-stream of events, with a keep-alive comment while there are none
+"""
+
+
+@bp.route("/documents/events/stream", methods=["GET"])
+def stream_document_events():
+    try:
+        after = int_arg(
+            request.headers.get("Last-Event-ID") or request.args.get("after"),
+            "after",
+            0,
+            2**63 - 1,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        store = get_store()
+    except StorageError as e:
+        return storage_error_response(e)
+
+    keepalive = current_app.config["EVENTS_KEEPALIVE"]
+    retry_ms = current_app.config["OVERLOAD_RETRY_AFTER"] * 1000
+
+    def generate():
+        cursor = after
+        while True:
+            try:
+                events = store.wait_for_events(cursor, 100, keepalive)
+            except StorageError as e:
+                # End the stream, the EventSource reconnects from its last id
+                print(f"Event stream stopped: {e}")
+                yield f"retry: {retry_ms}\n\n"
+                return
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            for event in serialize_events(events):
+                yield f"id: {event['event_id']}\ndata: {json.dumps(event)}\n\n"
+            cursor = events[-1]["event_id"]
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5001))
-    app.run(host="0.0.0.0", port=port)
+    create_app().run(host="0.0.0.0", port=port)
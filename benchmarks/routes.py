@@ -0,0 +1,128 @@
+# benchmarks/routes.py
+"""
+Microbenchmarks for the document routes against the in-memory SQLite store.
+
+No database server or network is needed, so this can run in CI or on a laptop
+to catch performance regressions in the route handlers and the data access
+layer. Set --backend postgres to run the same operations against DB_HOST.
+
+Usage: python benchmarks/routes.py [--iterations 200] [--file-size 65536]
+                                  [--max-us upload=20000 --max-us query=5000 ...]
+
+With --max-us the script exits with an error when an operation's median time
+is above the limit, in microseconds.
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from db import close_store, get_store  # noqa: E402
+from rate_limit import DEFAULT_RATE_LIMITS  # noqa: E402
+
+# Rate limits are lifted so they don't throttle the benchmark
+UNLIMITED = ",".join(f"{endpoint}=1e9/1e9" for endpoint in DEFAULT_RATE_LIMITS)
+
+
+def timed(iterations, func):
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        response = func(i)
+        timings.append((time.perf_counter() - start) * 1e6)
+        assert response.status_code < 300, response.get_json()
+    return timings
+
+
+def parse_limit(value):
+    name, limit = value.split("=")
+    return name, float(limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--backend", default="sqlite")
+    parser.add_argument(
+        "--max-us",
+        type=parse_limit,
+        action="append",
+        default=[],
+        help="Fail if the median of an operation is slower, e.g. upload=20000",
+    )
+    args = parser.parse_args()
+
+    app = create_app(
+        {"TESTING": True, "DB_BACKEND": args.backend, "RATE_LIMITS": UNLIMITED}
+    )
+    client = app.test_client()
+    store = get_store(app)
+    store.run("DELETE FROM documents WHERE property_id = 'bench'")
+    file_content = b"x" * args.file_size
+
+    def upload(i):
+        return client.post(
+            "/documents",
+            data={
+                "property_id": "bench",
+                "seller_id": "bench",
+                "uploaded_by": "seller",
+                "document_tag": "other",
+                "file": (io.BytesIO(file_content), f"{i}.bin", "text/plain"),
+            },
+            content_type="multipart/form-data",
+        )
+
+    def query_one(i):
+        return client.get("/documents/query?property_id=bench&seller_id=bench")
+
+    def query_missing(i):
+        return client.get("/documents/query?property_id=missing")
+
+    def delete(i):
+        return client.delete(
+            "/documents/delete?property_id=bench&uploaded_by=seller&document_tag=other"
+        )
+
+    # Upload processing prints every request, keep the output readable
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        results = {
+            "upload": timed(args.iterations, upload),
+            "query": timed(args.iterations, query_missing),
+            "query_all": timed(max(1, args.iterations // 10), query_one),
+            "delete": timed(1, delete),
+        }
+    finally:
+        sys.stdout = stdout
+        store.run("DELETE FROM documents WHERE property_id = 'bench'")
+        close_store(app)
+
+    print(f"backend: {args.backend}, file size: {args.file_size} bytes")
+    for name, timings in results.items():
+        print(
+            f"{name:<10} runs {len(timings):>5}  "
+            f"median {statistics.median(timings):>9.1f} us  "
+            f"max {max(timings):>9.1f} us"
+        )
+
+    failed = False
+    for name, limit in args.max_us:
+        if name not in results:
+            print(f"FAIL: unknown operation {name}, expected one of {list(results)}")
+            failed = True
+        elif statistics.median(results[name]) > limit:
+            print(f"FAIL: median {name} is slower than {limit:.0f} us")
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# benchmarks/startup.py
+"""
+Measures how long a fresh worker takes to import and create the app.
+
+Each run starts a new interpreter, so the numbers include module imports,
+which is what a newly scaled out worker pays before it can serve requests.
+
+Usage: python benchmarks/startup.py [--runs 20] [--max-ms 1000]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only be imported once a request needs them
+DEFERRED_MODULES = ["PIL", "pikepdf", "processing"]
+
+WORKER = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+app = create_app()
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "ms": elapsed * 1000,
+    "loaded": [m for m in %r if m in sys.modules],
+    "document_store": "document_store" in app.extensions,
+}))
+"""
+
+
+def run_worker():
+    output = subprocess.run(
+        [sys.executable, "-c", WORKER % (DEFERRED_MODULES,)],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--max-ms", type=float, help="Fail if the median startup is slower than this"
+    )
+    args = parser.parse_args()
+
+    results = [run_worker() for _ in range(args.runs)]
+    timings = sorted(result["ms"] for result in results)
+
+    print(f"runs:   {args.runs}")
+    print(f"min:    {timings[0]:.1f} ms")
+    print(f"median: {statistics.median(timings):.1f} ms")
+    print(f"max:    {timings[-1]:.1f} ms")
+
+    failed = False
+    loaded = sorted({m for result in results for m in result["loaded"]})
+    if loaded:
+        print(f"FAIL: deferred modules imported at startup: {loaded}")
+        failed = True
+    if any(result["document_store"] for result in results):
+        print("FAIL: database store created at startup")
+        failed = True
+    if args.max_ms is not None and statistics.median(timings) > args.max_ms:
+        print(f"FAIL: median startup is slower than {args.max_ms} ms")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
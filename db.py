@@ -0,0 +1,775 @@
+# db.py
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+
+_store_lock = threading.Lock()
+
+# Columns returned by queries, the image is base64 encoded by the routes
+QUERY_COLUMNS = {
+    "documents": [
+        "document_id",
+        "filename",
+        "file_type",
+        "image",
+        "datetime_uploaded",
+        "property_id",
+        "buyer_id",
+        "seller_id",
+        "uploaded_by",
+        "document_tag",
+    ],
+    "documents_buyer": [
+        "document_id",
+        "filename",
+        "file_type",
+        "image",
+        "datetime_uploaded",
+        "buyer_id",
+        "document_tag",
+    ],
+}
+
+# Columns that can be written or used in a filter, table and column names
+# are interpolated into SQL so they are always checked against this list
+TABLE_COLUMNS = {
+    table: columns + ["original_image", "processing_status"]
+    for table, columns in QUERY_COLUMNS.items()
+}
+
+# Columns of the document_events outbox, written by triggers on both tables
+EVENT_COLUMNS = [
+    "event_id",
+    "table_name",
+    "operation",
+    "document_id",
+    "property_id",
+    "buyer_id",
+    "seller_id",
+    "uploaded_by",
+    "document_tag",
+    "created_at",
+]
+
+# Waiting subscribers re-check the outbox at least this often (seconds), in
+# case a notification from another worker was missed
+EVENT_POLL_INTERVAL = 5
+
+# Default age (seconds) after which events are deleted, see EVENTS_RETENTION
+EVENTS_RETENTION = 7 * 24 * 60 * 60
+
+# Old events are deleted by a write at most this often (seconds) per store
+EVENT_PRUNE_INTERVAL = 60
+
+
+class StorageError(Exception):
+    """Raised by a document store when the database rejects a statement."""
+
+
+class StorageUnavailableError(StorageError):
+    """Raised when the database can't be reached or no connection became free in time."""
+
+
+"""
+This class holds the SQL shared by the database backends.
+
+Subclasses set the parameter placeholder and implement run(), which executes a
+single statement in its own transaction.
+"""
+
+
+class DocumentStore:
+    def __init__(self, config):
+        # Woken whenever document_events may have new rows
+        self.events_changed = threading.Condition()
+        self.events_generation = 0
+        self.events_retention = config.get("EVENTS_RETENTION", EVENTS_RETENTION)
+        self.events_pruned = None
+        self.prune_lock = threading.Lock()
+
+    def check_columns(self, table, columns):
+        if table not in TABLE_COLUMNS:
+            raise ValueError(f"Unknown table {table}")
+        unknown = [column for column in columns if column not in TABLE_COLUMNS[table]]
+        if unknown:
+            raise ValueError(f"Unknown columns for {table}: {unknown}")
+
+    def where_clause(self, filters):
+        conditions = [f"{column} = {self.placeholder}" for column in filters]
+        return " AND ".join(conditions) if conditions else "TRUE"
+
+    def ping(self):
+        return self.run("SELECT 1 AS ok", fetch=True)[0]["ok"] == 1
+
+    def insert_document(self, table, fields):
+        self.check_columns(table, fields)
+        columns = ", ".join(fields)
+        values = ", ".join([self.placeholder] * len(fields))
+        rows = self.run(
+            f"""
+            INSERT INTO {table} ({columns})
+            VALUES ({values})
+            RETURNING document_id
+            """,
+            list(fields.values()),
+            fetch=True,
+        )
+        self.notify_events()
+        self.prune_events_if_due()
+        return rows[0]["document_id"]
+
+    def query_documents(self, table, filters):
+        self.check_columns(table, filters)
+        rows = self.run(
+            f"""
+            SELECT {", ".join(QUERY_COLUMNS[table])}
+            FROM {table}
+            WHERE {self.where_clause(filters)}
+            ORDER BY datetime_uploaded DESC, document_id DESC
+            """,
+            list(filters.values()),
+            fetch=True,
+        )
+        for row in rows:
+            row["image"] = bytes(row["image"])
+        return rows
+
+    def get_document(self, table, document_id, columns):
+        self.check_columns(table, columns)
+        rows = self.run(
+            f"""
+            SELECT {", ".join(columns)}
+            FROM {table}
+            WHERE document_id = {self.placeholder}
+            """,
+            [document_id],
+            fetch=True,
+        )
+        if not rows:
+            return None
+        for column in ["image", "original_image"]:
+            if rows[0].get(column) is not None:
+                rows[0][column] = bytes(rows[0][column])
+        return rows[0]
+
+    def pending_document_ids(self, table, limit):
+        self.check_columns(table, [])
+        rows = self.run(
+            f"""
+            SELECT document_id
+            FROM {table}
+            WHERE processing_status = 'pending'
+            ORDER BY document_id
+            LIMIT {self.placeholder}
+            """,
+            [limit],
+            fetch=True,
+        )
+        return [row["document_id"] for row in rows]
+
+    def update_document(self, table, document_id, fields, filters=None):
+        filters = filters or {}
+        self.check_columns(table, list(fields) + list(filters))
+        assignments = ", ".join(f"{column} = {self.placeholder}" for column in fields)
+        conditions = {"document_id": document_id, **filters}
+        return self.run(
+            f"""
+            UPDATE {table}
+            SET {assignments}
+            WHERE {self.where_clause(conditions)}
+            """,
+            list(fields.values()) + list(conditions.values()),
+        )
+
+    def delete_documents(self, table, filters):
+        if not filters:
+            raise ValueError("Refusing to delete without any filters")
+        self.check_columns(table, filters)
+        deleted = self.run(
+            f"""
+            DELETE FROM {table}
+            WHERE {self.where_clause(filters)}
+            """,
+            list(filters.values()),
+        )
+        if deleted:
+            self.notify_events()
+            self.prune_events_if_due()
+        return deleted
+
+    def fetch_events(self, after, limit):
+        return self.run(
+            f"""
+            SELECT {", ".join(EVENT_COLUMNS)}
+            FROM document_events
+            WHERE event_id > {self.placeholder}
+            ORDER BY event_id
+            LIMIT {self.placeholder}
+            """,
+            [after, limit],
+            fetch=True,
+        )
+
+    def prune_events(self, retention):
+        # A cursor from before the deleted events resumes at the oldest one left
+        return self.run(
+            f"""
+            DELETE FROM document_events
+            WHERE created_at < {self.events_cutoff}
+            """,
+            [retention],
+        )
+
+    def prune_events_if_due(self):
+        # Runs on the write path so the outbox is bounded without a scheduler.
+        # The document is already committed, so a failure is only logged
+        if not self.events_retention:
+            return
+        with self.prune_lock:
+            now = time.monotonic()
+            if (
+                self.events_pruned is not None
+                and now - self.events_pruned < EVENT_PRUNE_INTERVAL
+            ):
+                return
+            self.events_pruned = now
+        try:
+            self.prune_events(self.events_retention)
+        except StorageError as e:
+            print(f"Could not delete old document events: {e}")
+
+    def notify_events(self):
+        with self.events_changed:
+            self.events_generation += 1
+            self.events_changed.notify_all()
+
+    """
+    This method returns the events after a cursor, waiting for new ones if
+    there are none yet.
+
+    It takes the following parameters:
+    - after: The event_id of the last event the caller has seen
+    - limit: The largest number of events to return
+    - timeout: How long to wait for an event, in seconds
+
+    It returns the following:
+    - A list of events ordered by event_id, empty if the timeout passed
+    """
+
+    def wait_for_events(self, after, limit, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.events_changed:
+                generation = self.events_generation
+            events = self.fetch_events(after, limit)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                return events
+            with self.events_changed:
+                if self.events_generation == generation:
+                    self.events_changed.wait(min(remaining, EVENT_POLL_INTERVAL))
+
+
+class PostgresStore(DocumentStore):
+    placeholder = "%s"
+    # created_at holds CURRENT_TIMESTAMP in the session time zone
+    events_cutoff = "LOCALTIMESTAMP - %s * INTERVAL '1 second'"
+
+    def __init__(self, config):
+        import psycopg2
+        from psycopg2.pool import ThreadedConnectionPool
+
+        super().__init__(config)
+        self.psycopg2 = psycopg2
+        self.connect_params = {
+            "host": config["DB_HOST"],
+            "database": config["DB_NAME"],
+            "user": config["DB_USER"],
+            "password": config["DB_PASS"],
+            "sslmode": "require",  # Add this for Azure PostgreSQL
+        }
+        try:
+            # Opens DB_POOL_MIN_CONN connections straight away
+            self.pool = ThreadedConnectionPool(
+                config["DB_POOL_MIN_CONN"],
+                config["DB_POOL_MAX_CONN"],
+                **self.connect_params,
+            )
+        except psycopg2.Error as e:
+            raise StorageUnavailableError(
+                f"Could not connect to the database: {e}"
+            ) from e
+        # getconn() raises instead of waiting when every connection is in use,
+        # so callers queue here for up to DB_POOL_TIMEOUT seconds first
+        self.slots = threading.BoundedSemaphore(config["DB_POOL_MAX_CONN"])
+        self.pool_timeout = config["DB_POOL_TIMEOUT"]
+        self.listener = None
+        self.listener_lock = threading.Lock()
+        self.closed = False
+
+    def run(self, sql, params=(), fetch=False):
+        from psycopg2.extras import RealDictCursor
+        from psycopg2.pool import PoolError
+
+        if not self.slots.acquire(timeout=self.pool_timeout):
+            raise StorageUnavailableError("All database connections are in use")
+
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            try:
+                cur.execute(sql, params)
+                result = (
+                    [dict(row) for row in cur.fetchall()] if fetch else cur.rowcount
+                )
+                conn.commit()
+                return result
+            finally:
+                cur.close()
+        except PoolError as e:
+            raise StorageUnavailableError(str(e)) from e
+        except self.psycopg2.Error as e:
+            if conn is not None and not conn.closed:
+                conn.rollback()
+            # The server can't be reached or dropped the connection
+            if isinstance(e, self.psycopg2.OperationalError):
+                raise StorageUnavailableError(str(e)) from e
+            raise StorageError(str(e)) from e
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn, close=bool(conn.closed))
+            self.slots.release()
+
+    # Create the tables if they don't exist
+    def init_schema(self):
+        self.run(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                document_id SERIAL PRIMARY KEY,
+                filename VARCHAR(250) NOT NULL,
+                file_type VARCHAR(50) NOT NULL,
+                image BYTEA NOT NULL,
+                datetime_uploaded TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                property_id VARCHAR(50) NOT NULL,
+                buyer_id VARCHAR(50),
+                seller_id VARCHAR(50),
+                uploaded_by VARCHAR(50) CHECK (uploaded_by IN ('buyer', 'seller')),
+                document_tag VARCHAR(50) NOT NULL,
+                original_image BYTEA,
+                processing_status VARCHAR(20) DEFAULT 'pending'
+            )
+        """
+        )
+        self.run(
+            """
+            CREATE TABLE IF NOT EXISTS documents_buyer (
+                document_id SERIAL PRIMARY KEY,
+                filename VARCHAR(250) NOT NULL,
+                file_type VARCHAR(50) NOT NULL,
+                image BYTEA NOT NULL,
+                datetime_uploaded TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                buyer_id VARCHAR(50),
+                document_tag VARCHAR(50) NOT NULL,
+                original_image BYTEA,
+                processing_status VARCHAR(20) DEFAULT 'pending'
+            )
+        """
+        )
+        # Tables created before upload processing was added. ALTER TABLE locks
+        # the table even when there is nothing to do, so only run what is missing
+        for table in QUERY_COLUMNS:
+            if not self.column_exists(table, "original_image"):
+                self.run(f"ALTER TABLE {table} ADD COLUMN original_image BYTEA")
+            if not self.column_exists(table, "processing_status"):
+                # Existing rows are marked as done so they aren't all reprocessed
+                self.run(
+                    f"""
+                    ALTER TABLE {table}
+                    ADD COLUMN processing_status VARCHAR(20) DEFAULT 'done'
+                """
+                )
+                self.run(
+                    f"ALTER TABLE {table} ALTER COLUMN processing_status SET DEFAULT 'pending'"
+                )
+            if not self.index_exists(f"{table}_pending"):
+                self.run(
+                    f"""
+                    CREATE INDEX IF NOT EXISTS {table}_pending ON {table} (document_id)
+                    WHERE processing_status = 'pending'
+                """
+                )
+        # Outbox of inserts and deletes, filled by triggers in the same
+        # transaction as the change and announced with NOTIFY on commit.
+        # Everything runs as one statement under an advisory lock so workers
+        # starting together don't race, and the triggers are only created when
+        # missing: they must never be dropped, or changes committed meanwhile
+        # would have no event, and creating one locks the table.
+        self.run(
+            """
+            DO $schema$
+            BEGIN
+                PERFORM pg_advisory_xact_lock(hashtext('document_events_schema'));
+
+                CREATE TABLE IF NOT EXISTS document_events (
+                    event_id BIGSERIAL PRIMARY KEY,
+                    table_name VARCHAR(50) NOT NULL,
+                    operation VARCHAR(10) NOT NULL,
+                    document_id INTEGER NOT NULL,
+                    property_id VARCHAR(50),
+                    buyer_id VARCHAR(50),
+                    seller_id VARCHAR(50),
+                    uploaded_by VARCHAR(50),
+                    document_tag VARCHAR(50),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+
+                CREATE OR REPLACE FUNCTION record_document_event()
+                RETURNS trigger AS $function$
+                DECLARE
+                    doc RECORD;
+                    new_event_id BIGINT;
+                BEGIN
+                    IF TG_OP = 'DELETE' THEN
+                        doc := OLD;
+                    ELSE
+                        doc := NEW;
+                    END IF;
+
+                    -- Hold a lock until commit so event_ids become visible in
+                    -- order and a consumer's cursor never skips a slower
+                    -- transaction
+                    PERFORM pg_advisory_xact_lock(hashtext('document_events'));
+
+                    IF TG_TABLE_NAME = 'documents' THEN
+                        INSERT INTO document_events
+                        (table_name, operation, document_id, property_id, buyer_id,
+                         seller_id, uploaded_by, document_tag)
+                        VALUES (TG_TABLE_NAME, lower(TG_OP), doc.document_id,
+                                doc.property_id, doc.buyer_id, doc.seller_id,
+                                doc.uploaded_by, doc.document_tag)
+                        RETURNING event_id INTO new_event_id;
+                    ELSE
+                        INSERT INTO document_events
+                        (table_name, operation, document_id, buyer_id, document_tag)
+                        VALUES (TG_TABLE_NAME, lower(TG_OP), doc.document_id,
+                                doc.buyer_id, doc.document_tag)
+                        RETURNING event_id INTO new_event_id;
+                    END IF;
+
+                    PERFORM pg_notify('document_events', new_event_id::text);
+                    RETURN NULL;
+                END;
+                $function$ LANGUAGE plpgsql;
+
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_trigger
+                    WHERE tgname = 'documents_events'
+                    AND tgrelid = 'documents'::regclass
+                ) THEN
+                    CREATE TRIGGER documents_events
+                    AFTER INSERT OR DELETE ON documents
+                    FOR EACH ROW EXECUTE FUNCTION record_document_event();
+                END IF;
+
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_trigger
+                    WHERE tgname = 'documents_buyer_events'
+                    AND tgrelid = 'documents_buyer'::regclass
+                ) THEN
+                    CREATE TRIGGER documents_buyer_events
+                    AFTER INSERT OR DELETE ON documents_buyer
+                    FOR EACH ROW EXECUTE FUNCTION record_document_event();
+                END IF;
+            END
+            $schema$
+        """
+        )
+        # Old events are deleted by age
+        if not self.index_exists("document_events_created_at"):
+            self.run(
+                """
+                CREATE INDEX IF NOT EXISTS document_events_created_at
+                ON document_events (created_at)
+            """
+            )
+
+    def column_exists(self, table, column):
+        return bool(
+            self.run(
+                """
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                AND table_name = %s AND column_name = %s
+                """,
+                [table, column],
+                fetch=True,
+            )
+        )
+
+    def index_exists(self, index):
+        return bool(
+            self.run(
+                """
+                SELECT 1 FROM pg_indexes
+                WHERE schemaname = current_schema() AND indexname = %s
+                """,
+                [index],
+                fetch=True,
+            )
+        )
+
+    def wait_for_events(self, after, limit, timeout):
+        # The listener connection is only opened once someone subscribes
+        self.start_listener()
+        return super().wait_for_events(after, limit, timeout)
+
+    def start_listener(self):
+        with self.listener_lock:
+            # Restarted if the previous listener thread died
+            if self.listener is None or not self.listener.is_alive():
+                self.listener = threading.Thread(
+                    target=self.listen, name="document-events-listener", daemon=True
+                )
+                self.listener.start()
+
+    def listen(self):
+        import select
+
+        # Wakes subscribers in this worker when any worker changes a document
+        while not self.closed:
+            try:
+                conn = self.psycopg2.connect(**self.connect_params)
+                conn.autocommit = True
+                try:
+                    conn.cursor().execute("LISTEN document_events")
+                    while not self.closed:
+                        if select.select([conn], [], [], EVENT_POLL_INTERVAL)[0]:
+                            conn.poll()
+                            if conn.notifies:
+                                conn.notifies.clear()
+                                self.notify_events()
+                finally:
+                    conn.close()
+            except Exception as e:
+                # Keep listening, subscribers fall back to polling meanwhile
+                print(f"Document event listener failed: {e}")
+                time.sleep(EVENT_POLL_INTERVAL)
+
+    def close(self):
+        self.closed = True
+        self.pool.closeall()
+
+
+"""
+This class stores documents in SQLite, by default in memory.
+
+It has the same tables and constraints as the Postgres schema so the routes
+behave the same, and is used for tests and benchmarks that can't reach a
+Postgres server.
+"""
+
+
+class SQLiteStore(DocumentStore):
+    placeholder = "?"
+    events_cutoff = "strftime('%Y-%m-%d %H:%M:%f', 'now', -? || ' seconds')"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.conn = sqlite3.connect(
+            config.get("SQLITE_PATH", ":memory:"), check_same_thread=False
+        )
+        self.conn.row_factory = sqlite3.Row
+        # A single connection is shared with the upload processing threads
+        self.lock = threading.Lock()
+
+    def run(self, sql, params=(), fetch=False):
+        with self.lock:
+            try:
+                cur = self.conn.execute(sql, params)
+                result = (
+                    [dict(row) for row in cur.fetchall()] if fetch else cur.rowcount
+                )
+                self.conn.commit()
+                return result
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                raise StorageError(str(e)) from e
+
+    def query_documents(self, table, filters):
+        rows = super().query_documents(table, filters)
+        # SQLite has no timestamp type, they are stored as ISO 8601 text
+        for row in rows:
+            row["datetime_uploaded"] = datetime.fromisoformat(row["datetime_uploaded"])
+        return rows
+
+    def fetch_events(self, after, limit):
+        events = super().fetch_events(after, limit)
+        for event in events:
+            event["created_at"] = datetime.fromisoformat(event["created_at"])
+        return events
+
+    def init_schema(self):
+        # SQLite doesn't enforce VARCHAR lengths, the CHECKs reject values that
+        # Postgres would reject as too long. Timestamps are millisecond text in
+        # UTC, like CURRENT_TIMESTAMP on the Azure server
+        now = "(strftime('%Y-%m-%d %H:%M:%f', 'now'))"
+        self.run(
+            f"""
+            CREATE TABLE IF NOT EXISTS documents (
+                document_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename VARCHAR(250) NOT NULL CHECK (length(filename) <= 250),
+                file_type VARCHAR(50) NOT NULL CHECK (length(file_type) <= 50),
+                image BLOB NOT NULL,
+                datetime_uploaded TEXT DEFAULT {now},
+                property_id VARCHAR(50) NOT NULL CHECK (length(property_id) <= 50),
+                buyer_id VARCHAR(50) CHECK (length(buyer_id) <= 50),
+                seller_id VARCHAR(50) CHECK (length(seller_id) <= 50),
+                uploaded_by VARCHAR(50)
+                    CHECK (length(uploaded_by) <= 50)
+                    CHECK (uploaded_by IN ('buyer', 'seller')),
+                document_tag VARCHAR(50) NOT NULL CHECK (length(document_tag) <= 50),
+                original_image BLOB,
+                processing_status VARCHAR(20) DEFAULT 'pending' CHECK (length(processing_status) <= 20)
+            )
+        """
+        )
+        self.run(
+            f"""
+            CREATE TABLE IF NOT EXISTS documents_buyer (
+                document_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename VARCHAR(250) NOT NULL CHECK (length(filename) <= 250),
+                file_type VARCHAR(50) NOT NULL CHECK (length(file_type) <= 50),
+                image BLOB NOT NULL,
+                datetime_uploaded TEXT DEFAULT {now},
+                buyer_id VARCHAR(50) CHECK (length(buyer_id) <= 50),
+                document_tag VARCHAR(50) NOT NULL CHECK (length(document_tag) <= 50),
+                original_image BLOB,
+                processing_status VARCHAR(20) DEFAULT 'pending' CHECK (length(processing_status) <= 20)
+            )
+        """
+        )
+
+        for table in QUERY_COLUMNS:
+            self.run(
+                f"""
+                CREATE INDEX IF NOT EXISTS {table}_pending ON {table} (document_id)
+                WHERE processing_status = 'pending'
+            """
+            )
+        # Outbox of inserts and deletes, filled by triggers in the same
+        # transaction as the change. SQLite has no NOTIFY, subscribers are woken
+        # by the store after each write
+        self.run(
+            f"""
+            CREATE TABLE IF NOT EXISTS document_events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name VARCHAR(50) NOT NULL CHECK (length(table_name) <= 50),
+                operation VARCHAR(10) NOT NULL CHECK (length(operation) <= 10),
+                document_id INTEGER NOT NULL,
+                property_id VARCHAR(50) CHECK (length(property_id) <= 50),
+                buyer_id VARCHAR(50) CHECK (length(buyer_id) <= 50),
+                seller_id VARCHAR(50) CHECK (length(seller_id) <= 50),
+                uploaded_by VARCHAR(50) CHECK (length(uploaded_by) <= 50),
+                document_tag VARCHAR(50) CHECK (length(document_tag) <= 50),
+                created_at TEXT DEFAULT {now}
+            )
+        """
+        )
+        self.run(
+            """
+            CREATE INDEX IF NOT EXISTS document_events_created_at
+            ON document_events (created_at)
+        """
+        )
+        for operation, row in [("insert", "NEW"), ("delete", "OLD")]:
+            self.run(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS documents_{operation}_event
+                AFTER {operation.upper()} ON documents
+                BEGIN
+                    INSERT INTO document_events
+                    (table_name, operation, document_id, property_id, buyer_id,
+                     seller_id, uploaded_by, document_tag)
+                    VALUES ('documents', '{operation}', {row}.document_id,
+                            {row}.property_id, {row}.buyer_id, {row}.seller_id,
+                            {row}.uploaded_by, {row}.document_tag);
+                END
+            """
+            )
+            self.run(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS documents_buyer_{operation}_event
+                AFTER {operation.upper()} ON documents_buyer
+                BEGIN
+                    INSERT INTO document_events
+                    (table_name, operation, document_id, buyer_id, document_tag)
+                    VALUES ('documents_buyer', '{operation}', {row}.document_id,
+                            {row}.buyer_id, {row}.document_tag);
+                END
+            """
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+STORES = {
+    "postgres": PostgresStore,
+    "sqlite": SQLiteStore,
+}
+
+
+"""
+This function returns the document store for the app.
+
+The store is created on first use rather than when the app is created, so a
+worker can start without reaching the database. The schema is checked once,
+when the store is created.
+
+It takes the following parameters:
+- app: The Flask app (optional, defaults to the current app)
+
+It returns the following:
+- The DocumentStore selected by the DB_BACKEND setting
+"""
+
+
+def get_store(app=None):
+    app = app or current_app._get_current_object()
+    store = app.extensions.get("document_store")
+    if store is not None:
+        return store
+
+    with _store_lock:
+        store = app.extensions.get("document_store")
+        if store is None:
+            backend = app.config["DB_BACKEND"]
+            if backend not in STORES:
+                raise ValueError(f"Unknown DB_BACKEND {backend}")
+            store = STORES[backend](app.config)
+            if app.config["DB_INIT_SCHEMA"]:
+                try:
+                    store.init_schema()
+                except Exception:
+                    # The next request retries with a new store, so this
+                    # one's connections must not be left open
+                    store.close()
+                    raise
+            app.extensions["document_store"] = store
+    return store
+
+
+def close_store(app):
+    # Upload processing writes to the store, so its workers are stopped first.
+    # The queue is only removed afterwards so running jobs can't start a new one
+    queue = app.extensions.get("processing_queue")
+    if queue is not None:
+        queue.shutdown()
+        app.extensions.pop("processing_queue", None)
+    store = app.extensions.pop("document_store", None)
+    if store is not None:
+        store.close()
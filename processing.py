@@ -0,0 +1,285 @@
+# processing.py
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from db import StorageError, get_store
+
+# Default largest width/height of a stored image, see MAX_IMAGE_DIMENSION
+MAX_IMAGE_DIMENSION = 4096
+
+# Only these tables can be written back to by the worker pool
+PROCESSED_TABLES = ["documents", "documents_buyer"]
+
+# Leading bytes of the file formats we expect to be uploaded
+MAGIC_SIGNATURES = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"PK\x03\x04", "application/zip"),
+]
+
+# Images that are re-encoded to strip metadata and downscale
+NORMALIZED_IMAGE_FORMATS = {
+    "image/jpeg": "JPEG",
+    "image/png": "PNG",
+    "image/webp": "WEBP",
+}
+
+_queue_lock = threading.Lock()
+
+
+"""
+This class holds the upload processing worker pool of one app.
+
+Documents are queued as (table, document_id), which is only unique within one
+app's database, so every app gets its own pool and queue.
+"""
+
+
+class ProcessingQueue:
+    def __init__(self, max_workers, max_queued):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="upload-processing"
+        )
+        self.max_queued = max_queued
+        # Documents waiting in or running on the executor
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.skipped = False
+        self.closed = False
+
+    def shutdown(self):
+        # Queued documents stay pending in the database, running ones finish
+        # so they don't write to a closed store
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_queue(app):
+    queue = app.extensions.get("processing_queue")
+    if queue is None:
+        with _queue_lock:
+            queue = app.extensions.get("processing_queue")
+            if queue is None:
+                queue = ProcessingQueue(
+                    app.config["PROCESSING_WORKERS"],
+                    app.config["PROCESSING_QUEUE_SIZE"],
+                )
+                app.extensions["processing_queue"] = queue
+    return queue
+
+
+"""
+This function detects the MIME type of a file from its leading bytes.
+
+It takes the following parameters:
+- data: The raw bytes of the file
+- declared_type: The content type sent by the client
+
+It returns the following:
+- The detected MIME type, or the declared type if the bytes are not recognised
+"""
+
+
+def detect_content_type(data, declared_type=None):
+    if not declared_type or declared_type == "None":
+        declared_type = "application/octet-stream"
+
+    detected = None
+    for signature, mime_type in MAGIC_SIGNATURES:
+        if data.startswith(signature):
+            detected = mime_type
+            break
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        detected = "image/webp"
+
+    if detected is None:
+        return declared_type
+
+    # Office documents (docx, xlsx, ...) are zip archives, keep the specific type
+    if detected == "application/zip" and declared_type.startswith(
+        "application/vnd.openxmlformats"
+    ):
+        return declared_type
+
+    return detected
+
+
+def normalize_image(data, file_type, max_dimension=MAX_IMAGE_DIMENSION):
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        # The colour profile is kept, wide-gamut photos look wrong without it
+        icc_profile = image.info.get("icc_profile")
+        # Apply the EXIF orientation before the EXIF block is dropped
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension))
+
+        image_format = NORMALIZED_IMAGE_FORMATS[file_type]
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        output = io.BytesIO()
+        # Saving without exif/info arguments drops the rest of the metadata
+        options = {"icc_profile": icc_profile} if icc_profile else {}
+        if image_format == "JPEG":
+            options.update(quality=90, optimize=True)
+        image.save(output, format=image_format, **options)
+        return output.getvalue()
+
+
+def linearize_pdf(data):
+    import pikepdf
+
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        output = io.BytesIO()
+        pdf.save(output, linearize=True)
+        return output.getvalue()
+
+
+"""
+This function runs the processing steps for a single uploaded file.
+
+It takes the following parameters:
+- data: The raw bytes of the file
+- declared_type: The content type sent by the client
+- max_dimension: The largest width/height of a stored image (optional)
+
+It returns the following:
+- The processed bytes
+- The detected MIME type
+"""
+
+
+def process_file(data, declared_type=None, max_dimension=MAX_IMAGE_DIMENSION):
+    file_type = detect_content_type(data, declared_type)
+
+    try:
+        if file_type in NORMALIZED_IMAGE_FORMATS:
+            data = normalize_image(data, file_type, max_dimension)
+        elif file_type == "application/pdf":
+            data = linearize_pdf(data)
+    except ImportError as e:
+        print(f"Skipping processing of {file_type}: {e}")
+    except Exception as e:
+        # A file that cannot be parsed is stored exactly as it was uploaded
+        print(f"Could not process {file_type}: {e}")
+
+    return data, file_type
+
+
+"""
+This function processes a stored document and writes the result back.
+
+The file is read from its row rather than kept in memory while it waits in the
+queue. Rows aren't claimed, so two workers that pick up the same pending
+document (e.g. both resuming pending documents on their first upload) both
+process it, but the update only applies while the row is still pending, so
+only the first result is written.
+
+It takes the following parameters:
+- table: The table the document was inserted into
+- document_id: The ID of the document in the table
+"""
+
+
+def process_upload(table, document_id):
+    if table not in PROCESSED_TABLES:
+        raise ValueError(f"Cannot process uploads for table {table}")
+
+    store = get_store()
+    document = store.get_document(
+        table, document_id, ["image", "file_type", "processing_status"]
+    )
+    if document is None or document["processing_status"] != "pending":
+        return
+
+    data, declared_type = document["image"], document["file_type"]
+    processed_data, file_type = process_file(
+        data, declared_type, current_app.config["MAX_IMAGE_DIMENSION"]
+    )
+    fields = {"processing_status": "done"}
+    if processed_data != data or file_type != declared_type:
+        fields["image"] = processed_data
+        fields["file_type"] = file_type
+        if current_app.config["KEEP_ORIGINAL_UPLOADS"] and processed_data != data:
+            fields["original_image"] = data
+
+    try:
+        store.update_document(
+            table, document_id, fields, {"processing_status": "pending"}
+        )
+    except StorageError as e:
+        print(f"Failed to write processed document {document_id} to {table}: {e}")
+
+
+def _run_processing(app, queue, table, document_id):
+    try:
+        with app.app_context():
+            process_upload(table, document_id)
+    except Exception as e:
+        print(f"Upload processing failed: {e}")
+    finally:
+        with queue.lock:
+            queue.queued.discard((table, document_id))
+            rescan = queue.skipped and not queue.queued and not queue.closed
+            if rescan:
+                queue.skipped = False
+        # Documents that didn't fit in the queue are still pending in the database
+        if rescan:
+            schedule_pending(app)
+
+
+"""
+This function queues a stored document for processing on the app's worker pool.
+
+Only the table and ID are queued and the queue holds at most
+PROCESSING_QUEUE_SIZE documents. A document that doesn't fit stays pending in
+the database and is queued again once the queue has drained.
+
+It takes the following parameters:
+- app: The Flask app the document was uploaded to
+- table: The table the document was inserted into
+- document_id: The ID of the document in the table
+
+It returns the following:
+- A future that completes once the document has been processed, or None if it wasn't queued
+"""
+
+
+def schedule_processing(app, table, document_id):
+    queue = get_queue(app)
+    key = (table, document_id)
+    with queue.lock:
+        if queue.closed or key in queue.queued:
+            return None
+        if len(queue.queued) >= queue.max_queued:
+            queue.skipped = True
+            return None
+        queue.queued.add(key)
+        return queue.executor.submit(_run_processing, app, queue, table, document_id)
+
+
+def schedule_pending(app):
+    # Picks up documents whose processing was lost, e.g. when a worker restarted
+    with app.app_context():
+        store = get_store()
+        for table in PROCESSED_TABLES:
+            try:
+                document_ids = store.pending_document_ids(
+                    table, app.config["PROCESSING_QUEUE_SIZE"]
+                )
+            except StorageError as e:
+                print(f"Could not look up pending documents in {table}: {e}")
+                continue
+            for document_id in document_ids:
+                schedule_processing(app, table, document_id)
@@ -0,0 +1,318 @@
+# rate_limit.py
+import math
+import threading
+import time
+from functools import partial
+
+from flask import g, jsonify, request
+
+# Requests per second and burst size for each route, keyed by endpoint name
+DEFAULT_RATE_LIMITS = {
+    "add_document": (5, 20),
+    "add_document_buyer": (5, 20),
+    "query_documents": (20, 50),
+    "query_documents_buyer": (20, 50),
+    "delete_document": (5, 20),
+    "delete_document_buyer": (5, 20),
+    "document_events": (5, 20),
+    "stream_document_events": (1, 5),
+}
+
+# Endpoints that are never limited
+EXEMPT_ENDPOINTS = ["route", "static", "rate_limit_metrics"]
+
+# Long-lived event subscriptions, rate limited and capped separately from
+# in-flight requests so waiting subscribers can't starve the other routes
+SUBSCRIPTION_ENDPOINTS = ["document_events", "stream_document_events"]
+
+# Endpoints whose request bodies count towards the in-flight upload bytes
+UPLOAD_ENDPOINTS = ["add_document", "add_document_buyer"]
+
+MAX_CONCURRENT_REQUESTS = 32
+MAX_INFLIGHT_UPLOAD_BYTES = 200 * 1024 * 1024
+MAX_SUBSCRIBERS = 8
+# Open subscriptions per client, so one client can't hold every slot
+MAX_SUBSCRIBERS_PER_CLIENT = 2
+OVERLOAD_RETRY_AFTER = 1
+
+# Idle buckets are dropped once there are more than this many
+MAX_BUCKETS = 10000
+
+
+def parse_rate_limits(value):
+    """Parse limits in the form "query_documents=20/50,add_document=5/20"."""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        endpoint, limit = item.split("=")
+        rate, burst = (float(value) for value in limit.split("/"))
+        if rate <= 0 or burst < 1:
+            raise ValueError(
+                f"Rate limit for {endpoint.strip()} needs a rate above 0 and a burst of at least 1"
+            )
+        limits[endpoint.strip()] = (rate, burst)
+    return limits
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        # A clock read just before another thread's update must not remove tokens
+        elapsed = max(0, now - self.updated)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = max(self.updated, now)
+
+    def take(self, now):
+        """Take a token, returning 0 or the number of seconds until one is available."""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        rate_limits=None,
+        max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+        max_inflight_upload_bytes=MAX_INFLIGHT_UPLOAD_BYTES,
+        max_subscribers=MAX_SUBSCRIBERS,
+        max_subscribers_per_client=MAX_SUBSCRIBERS_PER_CLIENT,
+    ):
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+        self.rate_limits.update(rate_limits or {})
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_inflight_upload_bytes = max_inflight_upload_bytes
+        self.max_subscribers = max_subscribers
+        self.max_subscribers_per_client = max_subscribers_per_client
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buckets = {}
+            self.concurrent_requests = 0
+            self.inflight_upload_bytes = 0
+            self.subscribers = 0
+            self.client_subscribers = {}
+            self.counters = {
+                "allowed": 0,
+                "rate_limited": 0,
+                "shed_concurrency": 0,
+                "shed_upload_bytes": 0,
+                "too_large": 0,
+                "shed_subscribers": 0,
+                "shed_client_subscribers": 0,
+            }
+
+    def prune_buckets(self, now):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+    def check_rate(self, client_id, endpoint):
+        rate, burst = self.rate_limits[endpoint]
+        with self.lock:
+            now = time.monotonic()
+            key = (client_id, endpoint)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= MAX_BUCKETS:
+                    self.prune_buckets(now)
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+            return bucket.take(now)
+
+    def admit(self, upload_bytes):
+        """Reserve a request slot and upload bytes, returning the reason if refused."""
+        with self.lock:
+            if upload_bytes > self.max_inflight_upload_bytes:
+                self.counters["too_large"] += 1
+                return "too_large"
+            if self.concurrent_requests >= self.max_concurrent_requests:
+                self.counters["shed_concurrency"] += 1
+                return "concurrency"
+            if (
+                upload_bytes
+                and self.inflight_upload_bytes + upload_bytes
+                > self.max_inflight_upload_bytes
+            ):
+                self.counters["shed_upload_bytes"] += 1
+                return "upload_bytes"
+            self.concurrent_requests += 1
+            self.inflight_upload_bytes += upload_bytes
+            self.counters["allowed"] += 1
+            return None
+
+    def admit_subscriber(self, client_id):
+        """Reserve a subscription slot for a client, returning the reason if refused."""
+        with self.lock:
+            client_subscribers = self.client_subscribers.get(client_id, 0)
+            if client_subscribers >= self.max_subscribers_per_client:
+                self.counters["shed_client_subscribers"] += 1
+                return "client"
+            if self.subscribers >= self.max_subscribers:
+                self.counters["shed_subscribers"] += 1
+                return "subscribers"
+            self.subscribers += 1
+            self.client_subscribers[client_id] = client_subscribers + 1
+            self.counters["allowed"] += 1
+            return None
+
+    def release_subscriber(self, client_id):
+        with self.lock:
+            self.subscribers -= 1
+            self.client_subscribers[client_id] -= 1
+            if not self.client_subscribers[client_id]:
+                del self.client_subscribers[client_id]
+
+    def release(self, upload_bytes):
+        with self.lock:
+            self.concurrent_requests -= 1
+            self.inflight_upload_bytes -= upload_bytes
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "concurrent_requests": self.concurrent_requests,
+                "max_concurrent_requests": self.max_concurrent_requests,
+                "inflight_upload_bytes": self.inflight_upload_bytes,
+                "max_inflight_upload_bytes": self.max_inflight_upload_bytes,
+                "subscribers": self.subscribers,
+                "max_subscribers": self.max_subscribers,
+                "max_subscribers_per_client": self.max_subscribers_per_client,
+                "tracked_clients": len(self.buckets),
+                "rate_limits": {
+                    endpoint: {"rate": rate, "burst": burst}
+                    for endpoint, (rate, burst) in self.rate_limits.items()
+                },
+            }
+
+
+def get_client_id():
+    # Headers like X-Forwarded-For can be set by the client, so only the peer
+    # address is trusted. Behind a proxy, PROXY_FIX_X_FOR makes the app resolve
+    # remote_addr through the configured number of trusted hops.
+    return request.remote_addr
+
+
+def limit_response(error, status, retry_after):
+    response = jsonify({"error": error})
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+"""
+This function registers rate limiting and admission control on the app.
+
+Every request is checked before the view runs, so a refused request never
+reads its body or opens a database connection.
+
+It takes the following parameters:
+- app: The Flask app
+- limiter: The RateLimiter to use (optional, built from the app config if missing)
+
+It returns the following:
+- The RateLimiter, which is also stored in app.extensions["rate_limiter"]
+"""
+
+
+def init_app(app, limiter=None):
+    if limiter is None:
+        limiter = RateLimiter(
+            parse_rate_limits(app.config.get("RATE_LIMITS", "")),
+            app.config.get("MAX_CONCURRENT_REQUESTS", MAX_CONCURRENT_REQUESTS),
+            app.config.get("MAX_INFLIGHT_UPLOAD_BYTES", MAX_INFLIGHT_UPLOAD_BYTES),
+            app.config.get("MAX_SUBSCRIBERS", MAX_SUBSCRIBERS),
+            app.config.get("MAX_SUBSCRIBERS_PER_CLIENT", MAX_SUBSCRIBERS_PER_CLIENT),
+        )
+    app.extensions["rate_limiter"] = limiter
+    retry_after = app.config.get("OVERLOAD_RETRY_AFTER", OVERLOAD_RETRY_AFTER)
+
+    @app.before_request
+    def check_limits():
+        if request.endpoint is None:
+            return None
+        # Limits are keyed by view name, without the blueprint prefix
+        endpoint = request.endpoint.rpartition(".")[2]
+        if endpoint in EXEMPT_ENDPOINTS:
+            return None
+
+        if endpoint in limiter.rate_limits:
+            wait = limiter.check_rate(get_client_id(), endpoint)
+            if wait:
+                with limiter.lock:
+                    limiter.counters["rate_limited"] += 1
+                return limit_response("Rate limit exceeded", 429, wait)
+
+        if endpoint in SUBSCRIPTION_ENDPOINTS:
+            client_id = get_client_id()
+            refused = limiter.admit_subscriber(client_id)
+            if refused == "client":
+                return limit_response(
+                    "Too many open event subscriptions for this client",
+                    429,
+                    retry_after,
+                )
+            if refused:
+                return limit_response(
+                    "Too many event subscribers, try again later", 503, retry_after
+                )
+            g.subscriber_client = client_id
+            return None
+
+        upload_bytes = 0
+        if endpoint in UPLOAD_ENDPOINTS:
+            # A chunked upload's size isn't known until it has been read
+            if request.content_length is None:
+                return jsonify({"error": "Content-Length is required"}), 411
+            upload_bytes = request.content_length
+            max_content_length = app.config.get("MAX_CONTENT_LENGTH")
+            if max_content_length and upload_bytes > max_content_length:
+                with limiter.lock:
+                    limiter.counters["too_large"] += 1
+                return jsonify({"error": "Upload is too large"}), 413
+
+        refused = limiter.admit(upload_bytes)
+        if refused == "too_large":
+            return jsonify({"error": "Upload is too large"}), 413
+        if refused:
+            return limit_response(
+                "Service is overloaded, try again later", 503, retry_after
+            )
+
+        g.admitted_upload_bytes = upload_bytes
+        return None
+
+    @app.after_request
+    def hold_subscriber_slot(response):
+        # A streamed response outlives the request, so its slot is released
+        # when the server closes the response (e.g. the client disconnects)
+        if "subscriber_client" in g:
+            client_id = g.pop("subscriber_client")
+            response.call_on_close(partial(limiter.release_subscriber, client_id))
+        return response
+
+    @app.teardown_request
+    def release_limits(exc):
+        upload_bytes = g.pop("admitted_upload_bytes", None)
+        if upload_bytes is not None:
+            limiter.release(upload_bytes)
+        # Only still set if no response was produced
+        if "subscriber_client" in g:
+            limiter.release_subscriber(g.pop("subscriber_client"))
+
+    @app.route("/metrics/rate_limits", methods=["GET"])
+    def rate_limit_metrics():
+        return jsonify(limiter.metrics())
+
+    return limiter
@@ -1,22 +1,33 @@
 import pytest
-from app import app, init_db, get_db_connection
+import psycopg2
+from app import create_app
+from db import StorageError, close_store, get_store
 import io
+import json
+import threading
+import time
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def app(request):
+    """App fixture, runs each test against SQLite and, when configured, Postgres"""
+    app = create_app({"TESTING": True, "DB_BACKEND": request.param})
+    if request.param == "postgres" and not app.config["DB_HOST"]:
+        pytest.skip("DB_HOST is not set")
+    yield app
+    close_store(app)
 
 
 @pytest.fixture
-def client():
+def client(app):
     """Test client fixture that sets up and tears down test data"""
-    app.config["TESTING"] = True
     with app.test_client() as client:
-        # Set up test database
-        conn = get_db_connection()
-        cur = conn.cursor()
+        # Set up test database, the tables are created with the store
+        store = get_store(app)
 
-        # Create tables and clean existing test data
-        init_db()
-        cur.execute("DELETE FROM documents")
-        cur.execute("DELETE FROM documents_buyer")  # Also clean buyer documents table
-        conn.commit()
+        # Clean existing test data
+        store.run("DELETE FROM documents")
+        store.run("DELETE FROM documents_buyer")  # Also clean buyer documents table
 
         # Create test file data
         test_file_content = b"Test file content"
@@ -38,31 +49,91 @@ def client():
 
         assert response.status_code == 201
 
-        conn.commit()
-        cur.close()
-        conn.close()
-
         yield client
 
         # Cleanup after tests
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM documents WHERE property_id = '999'")
-        conn.commit()
-        cur.close()
-        conn.close()
+        store.run("DELETE FROM documents WHERE property_id = '999'")
+
+
+def test_create_app_does_not_connect(monkeypatch):
+    """Test that creating the app doesn't open a database connection"""
+
+    def fail_connect(*args, **kwargs):
+        raise AssertionError("create_app connected to the database")
+
+    monkeypatch.setattr(psycopg2, "connect", fail_connect)
+    app = create_app({"TESTING": True, "DB_BACKEND": "postgres"})
+    assert "document_store" not in app.extensions
+
+    response = app.test_client().get("/")
+    assert response.status_code == 200
+
+
+def test_database_busy():
+    """Test that running out of pooled connections answers 503, not 400 or 500"""
+    app = create_app(
+        {
+            "TESTING": True,
+            "DB_BACKEND": "postgres",
+            "DB_POOL_MIN_CONN": 0,
+            "DB_POOL_MAX_CONN": 1,
+            "DB_POOL_TIMEOUT": 0.01,
+            "DB_INIT_SCHEMA": False,
+        }
+    )
+    store = get_store(app)
+    store.slots.acquire()  # Another request holds the only connection
+    try:
+        response = app.test_client().get("/documents/query/buyer?buyer_id=888")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        assert "connections are in use" in response.get_json()["error"]
+    finally:
+        store.slots.release()
+        close_store(app)
+
 
+def test_database_unreachable(monkeypatch):
+    """Test that a database that can't be reached answers 503 as JSON"""
 
-def test_database_connection():
+    def fail_connect(*args, **kwargs):
+        raise psycopg2.OperationalError("could not connect to server")
+
+    monkeypatch.setattr(psycopg2, "connect", fail_connect)
+    app = create_app({"TESTING": True, "DB_BACKEND": "postgres"})
+    client = app.test_client()
+
+    for url in ["/documents/query", "/documents/events/stream"]:
+        response = client.get(url)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        assert "Could not connect" in response.get_json()["error"]
+    assert "document_store" not in app.extensions
+
+
+def test_schema_failure_closes_store(monkeypatch):
+    """Test that a store whose schema setup failed doesn't keep its connections"""
+    from db import PostgresStore
+
+    closed = []
+
+    def fail_init_schema(self):
+        raise StorageError("permission denied for schema public")
+
+    monkeypatch.setattr(PostgresStore, "init_schema", fail_init_schema)
+    monkeypatch.setattr(PostgresStore, "close", lambda self: closed.append(self))
+    app = create_app({"TESTING": True, "DB_BACKEND": "postgres", "DB_POOL_MIN_CONN": 0})
+
+    response = app.test_client().get("/documents/query")
+    assert response.status_code == 400
+    assert len(closed) == 1
+    assert "document_store" not in app.extensions
+
+
+def test_database_connection(app):
     """Test that database connection works"""
-    conn = get_db_connection()
-    assert conn is not None
-    cur = conn.cursor()
-    cur.execute("SELECT 1")
-    result = cur.fetchone()
-    assert result[0] == 1
-    cur.close()
-    conn.close()
+    with app.app_context():
+        assert get_store().ping()
 
 
 def test_query_documents_empty(client):
@@ -185,6 +256,34 @@ def test_add_document_buyer(client):
     assert data["documents"][0]["document_tag"] == "identification"
 
 
+def test_add_document_without_content_type(client):
+    """Test that a file part without a Content-Type header is still stored"""
+    boundary = "test-boundary"
+    body = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="buyer_id"\r\n\r\n'
+        "888\r\n"
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="document_tag"\r\n\r\n'
+        "passport\r\n"
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="scan"\r\n\r\n'
+        "Buyer document content\r\n"
+        f"--{boundary}--\r\n"
+    ).encode()
+
+    response = client.post(
+        "/documents/buyer",
+        data=body,
+        content_type=f"multipart/form-data; boundary={boundary}",
+    )
+    assert response.status_code == 201
+
+    response = client.get("/documents/query/buyer?buyer_id=888")
+    document = response.get_json()["documents"][0]
+    assert document["file_type"] == "application/octet-stream"
+
+
 def test_delete_document_buyer(client):
     """Test deleting a document from the buyer table"""
     # First, add a document to delete
@@ -220,3 +319,233 @@ def test_delete_document_buyer(client):
     assert response.status_code == 200
     final_data = response.get_json()
     assert final_data["count"] == 0
+
+
+def test_add_document_value_too_long(client):
+    """Test that values longer than their column are rejected on every backend"""
+    data = {
+        "property_id": "9" * 51,
+        "seller_id": "777",
+        "uploaded_by": "seller",
+        "document_tag": "other",
+        "file": (io.BytesIO(b"Test file content"), "test.pdf", "application/pdf"),
+    }
+    response = client.post("/documents", data=data, content_type="multipart/form-data")
+    assert response.status_code == 400
+
+    data = {
+        "buyer_id": "888",
+        "document_tag": "other",
+        "file": (io.BytesIO(b"Test file content"), "test.bin", "x/" + "y" * 49),
+    }
+    response = client.post(
+        "/documents/buyer", data=data, content_type="multipart/form-data"
+    )
+    assert response.status_code == 400
+
+
+def test_store_filters_and_order(app):
+    """Test that both stores filter, order newest first and delete the same way"""
+    store = get_store(app)
+    store.run("DELETE FROM documents_buyer")
+    for tag in ["passport", "other", "passport"]:
+        store.insert_document(
+            "documents_buyer",
+            {
+                "filename": f"{tag}.pdf",
+                "file_type": "application/pdf",
+                "image": b"%PDF-1.7",
+                "buyer_id": "555",
+                "document_tag": tag,
+            },
+        )
+
+    documents = store.query_documents("documents_buyer", {"buyer_id": "555"})
+    assert [doc["document_tag"] for doc in documents] == [
+        "passport",
+        "other",
+        "passport",
+    ]
+    assert documents[0]["document_id"] > documents[-1]["document_id"]
+    assert documents[0]["image"] == b"%PDF-1.7"
+
+    deleted = store.delete_documents(
+        "documents_buyer", {"buyer_id": "555", "document_tag": "passport"}
+    )
+    assert deleted == 2
+    assert len(store.query_documents("documents_buyer", {"buyer_id": "555"})) == 1
+
+    with pytest.raises(ValueError):
+        store.delete_documents("documents_buyer", {})
+    store.run("DELETE FROM documents_buyer WHERE buyer_id = '555'")
+
+
+def latest_event_id(app):
+    rows = get_store(app).run(
+        "SELECT MAX(event_id) AS event_id FROM document_events", fetch=True
+    )
+    return rows[0]["event_id"] or 0
+
+
+def test_document_events(client, app):
+    """Test that inserts and deletes are published with a resumable cursor"""
+    cursor = latest_event_id(app)
+
+    data = {
+        "buyer_id": "999",
+        "document_tag": "passport",
+        "file": (io.BytesIO(b"Buyer document"), "passport.jpg", "image/jpeg"),
+    }
+    response = client.post(
+        "/documents/buyer", data=data, content_type="multipart/form-data"
+    )
+    document_id = response.get_json()["document_id"]
+    client.delete("/documents/buyer/delete?buyer_id=999&document_tag=passport")
+
+    response = client.get(f"/documents/events?after={cursor}&timeout=0")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["count"] == 2
+    assert [event["operation"] for event in data["events"]] == ["insert", "delete"]
+    for event in data["events"]:
+        assert event["table_name"] == "documents_buyer"
+        assert event["document_id"] == document_id
+        assert event["buyer_id"] == "999"
+    assert data["cursor"] == data["events"][-1]["event_id"]
+
+    # Resuming from the cursor returns nothing new
+    response = client.get(f"/documents/events?after={data['cursor']}&timeout=0")
+    assert response.get_json() == {"count": 0, "events": [], "cursor": data["cursor"]}
+
+
+def test_document_events_long_poll(client, app):
+    """Test that a waiting subscriber is woken by a new document"""
+    cursor = latest_event_id(app)
+    result = {}
+
+    def subscribe():
+        result["response"] = app.test_client().get(
+            f"/documents/events?after={cursor}&timeout=10"
+        )
+
+    thread = threading.Thread(target=subscribe)
+    thread.start()
+    data = {
+        "property_id": "999",
+        "seller_id": "777",
+        "uploaded_by": "seller",
+        "document_tag": "floor_plan",
+        "file": (io.BytesIO(b"Floor plan"), "plan.pdf", "application/pdf"),
+    }
+    client.post("/documents", data=data, content_type="multipart/form-data")
+    thread.join(5)
+
+    assert not thread.is_alive()
+    events = result["response"].get_json()["events"]
+    assert events[0]["operation"] == "insert"
+    assert events[0]["property_id"] == "999"
+    assert events[0]["document_tag"] == "floor_plan"
+
+
+def test_document_events_stream(client, app):
+    """Test that events are streamed as Server-Sent Events from Last-Event-ID"""
+    cursor = latest_event_id(app)
+    data = {
+        "buyer_id": "999",
+        "document_tag": "other",
+        "file": (io.BytesIO(b"Other document"), "other.pdf", "application/pdf"),
+    }
+    client.post("/documents/buyer", data=data, content_type="multipart/form-data")
+
+    response = client.get(
+        "/documents/events/stream", headers={"Last-Event-ID": str(cursor)}
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    chunk = next(response.response).decode()
+    response.close()
+
+    event_id, data = chunk.strip().split("\n")
+    assert int(event_id.removeprefix("id: ")) > cursor
+    event = json.loads(data.removeprefix("data: "))
+    assert event["table_name"] == "documents_buyer"
+    assert event["operation"] == "insert"
+
+
+def test_document_events_default_timeout_is_capped(client, app):
+    """Test that the default timeout doesn't exceed EVENTS_MAX_TIMEOUT"""
+    app.config["EVENTS_MAX_TIMEOUT"] = 0
+    cursor = latest_event_id(app)
+
+    started = time.monotonic()
+    response = client.get(f"/documents/events?after={cursor}")
+    assert response.status_code == 200
+    assert response.get_json()["count"] == 0
+    assert time.monotonic() - started < 1
+
+
+def test_document_events_invalid_cursor(client):
+    """Test that a cursor that isn't a number is rejected"""
+    response = client.get("/documents/events?after=abc")
+    assert response.status_code == 400
+    assert "after must be an integer" in response.get_json()["error"]
+
+
+def test_document_events_retention(client, app):
+    """Test that old events are deleted and an old cursor resumes at the oldest left"""
+    store = get_store(app)
+    cursor = latest_event_id(app)
+    store.run("UPDATE document_events SET created_at = '2000-01-01 00:00:00.000'")
+
+    # The next write deletes old events once the prune interval has passed
+    store.events_pruned = None
+    data = {
+        "buyer_id": "999",
+        "document_tag": "passport",
+        "file": (io.BytesIO(b"Passport scan"), "passport.pdf", "application/pdf"),
+    }
+    response = client.post(
+        "/documents/buyer", data=data, content_type="multipart/form-data"
+    )
+    assert response.status_code == 201
+    document_id = response.get_json()["document_id"]
+
+    response = client.get("/documents/events?after=0&timeout=0")
+    events = response.get_json()["events"]
+    assert [(event["operation"], event["document_id"]) for event in events] == [
+        ("insert", document_id)
+    ]
+    assert events[0]["event_id"] > cursor
+
+
+def test_document_events_stream_storage_error(client, app, monkeypatch):
+    """Test that a database error ends the stream with a retry hint"""
+
+    def fail(*args, **kwargs):
+        raise StorageError("All database connections are in use")
+
+    monkeypatch.setattr(get_store(app), "wait_for_events", fail)
+    response = client.get("/documents/events/stream")
+    assert list(response.response) == [b"retry: 1000\n\n"]
+
+
+def test_event_listener_restarts():
+    """Test that a listener thread that died is started again"""
+    app = create_app(
+        {
+            "TESTING": True,
+            "DB_BACKEND": "postgres",
+            "DB_POOL_MIN_CONN": 0,
+            "DB_INIT_SCHEMA": False,
+        }
+    )
+    store = get_store(app)
+    store.listen = lambda: None  # Exits at once, like a listener that crashed
+    try:
+        store.start_listener()
+        first = store.listener
+        first.join(5)
+        store.start_listener()
+        assert store.listener is not first
+    finally:
+        close_store(app)
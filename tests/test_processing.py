@@ -0,0 +1,220 @@
+import io
+import time
+
+import pikepdf
+import pytest
+from PIL import Image, ImageCms
+
+from app import create_app
+from db import close_store, get_store
+from processing import (
+    detect_content_type,
+    process_file,
+    process_upload,
+    schedule_pending,
+    schedule_processing,
+)
+
+
+@pytest.fixture
+def app():
+    """App using the in-memory SQLite store"""
+    app = create_app({"TESTING": True, "DB_BACKEND": "sqlite"})
+    yield app
+    close_store(app)
+
+
+def insert_document(app, data, file_type):
+    return get_store(app).insert_document(
+        "documents_buyer",
+        {
+            "filename": "upload",
+            "file_type": file_type,
+            "image": data,
+            "buyer_id": "888",
+            "document_tag": "passport",
+        },
+    )
+
+
+def get_document(app, document_id):
+    return get_store(app).get_document(
+        "documents_buyer",
+        document_id,
+        ["image", "file_type", "original_image", "processing_status"],
+    )
+
+
+def make_image(size, image_format="JPEG", **options):
+    output = io.BytesIO()
+    image = Image.new("RGB", size, "white")
+    image.save(output, format=image_format, **options)
+    return output.getvalue()
+
+
+def test_detect_content_type_from_magic_bytes():
+    """Test that the content type comes from the file contents, not the client"""
+    assert detect_content_type(b"%PDF-1.7 ...", "image/jpeg") == "application/pdf"
+    assert detect_content_type(make_image((10, 10)), "None") == "image/jpeg"
+    assert detect_content_type(make_image((10, 10), "PNG"), None) == "image/png"
+
+
+def test_detect_content_type_unknown_bytes():
+    """Test that unrecognised files keep the declared type"""
+    assert detect_content_type(b"Test file content", "application/pdf") == (
+        "application/pdf"
+    )
+    assert detect_content_type(b"Test file content", "None") == (
+        "application/octet-stream"
+    )
+
+
+def test_detect_content_type_office_document():
+    """Test that zip based office documents keep their specific type"""
+    docx = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    assert detect_content_type(b"PK\x03\x04...", docx) == docx
+    assert detect_content_type(b"PK\x03\x04...", "None") == "application/zip"
+
+
+def test_process_file_strips_exif_and_downscales():
+    """Test that large photos are downscaled and lose their EXIF block"""
+    exif = Image.Exif()
+    exif[0x010F] = "Test Camera"  # Make
+    data = make_image((5000, 2500), exif=exif.tobytes())
+
+    processed, file_type = process_file(data, "application/octet-stream")
+
+    assert file_type == "image/jpeg"
+    with Image.open(io.BytesIO(processed)) as image:
+        assert max(image.size) == 4096
+        assert "exif" not in image.info
+
+
+def test_process_file_linearizes_pdf():
+    """Test that PDFs are rewritten as linearized PDFs"""
+    pdf = pikepdf.new()
+    pdf.add_blank_page()
+    output = io.BytesIO()
+    pdf.save(output)
+
+    processed, file_type = process_file(output.getvalue(), "application/pdf")
+
+    assert file_type == "application/pdf"
+    with pikepdf.open(io.BytesIO(processed)) as pdf:
+        assert pdf.is_linearized
+
+
+def test_process_file_invalid_image():
+    """Test that a file that cannot be parsed is left unchanged"""
+    data = b"\xff\xd8\xff not really a jpeg"
+    processed, file_type = process_file(data, "image/jpeg")
+    assert processed == data
+    assert file_type == "image/jpeg"
+
+
+def test_process_file_keeps_icc_profile():
+    """Test that the colour profile survives re-encoding"""
+    icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    data = make_image((10, 10), icc_profile=icc_profile)
+
+    processed, _ = process_file(data, "image/jpeg")
+
+    with Image.open(io.BytesIO(processed)) as image:
+        assert image.info["icc_profile"] == icc_profile
+
+
+def test_process_upload_writes_back(app):
+    """Test that the processed file replaces the upload and the original is kept"""
+    exif = Image.Exif()
+    exif[0x010F] = "Test Camera"  # Make
+    data = make_image((100, 100), exif=exif.tobytes())
+    document_id = insert_document(app, data, "application/octet-stream")
+    assert get_document(app, document_id)["processing_status"] == "pending"
+
+    with app.app_context():
+        process_upload("documents_buyer", document_id)
+
+    document = get_document(app, document_id)
+    assert document["processing_status"] == "done"
+    assert document["file_type"] == "image/jpeg"
+    assert document["image"] != data
+    assert document["original_image"] == data
+
+
+def test_process_upload_without_original(app):
+    """Test that the original isn't kept when KEEP_ORIGINAL_UPLOADS is off"""
+    app.config["KEEP_ORIGINAL_UPLOADS"] = False
+    document_id = insert_document(app, make_image((100, 100)), "image/jpeg")
+
+    with app.app_context():
+        process_upload("documents_buyer", document_id)
+
+    document = get_document(app, document_id)
+    assert document["processing_status"] == "done"
+    assert document["original_image"] is None
+
+
+def test_process_upload_unchanged_file(app):
+    """Test that a file that needs no changes is only marked as done"""
+    document_id = insert_document(app, b"Test file content", "text/plain")
+
+    with app.app_context():
+        process_upload("documents_buyer", document_id)
+
+    document = get_document(app, document_id)
+    assert document["processing_status"] == "done"
+    assert document["image"] == b"Test file content"
+    assert document["file_type"] == "text/plain"
+    assert document["original_image"] is None
+
+
+def test_schedule_pending(app):
+    """Test that documents left pending, e.g. by a restart, are processed"""
+    document_ids = [
+        insert_document(app, b"%PDF-1.7 not really", "None") for _ in range(3)
+    ]
+
+    schedule_pending(app)
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        documents = [get_document(app, document_id) for document_id in document_ids]
+        if all(doc["processing_status"] == "done" for doc in documents):
+            break
+        time.sleep(0.01)
+    assert [doc["processing_status"] for doc in documents] == ["done"] * 3
+    assert [doc["file_type"] for doc in documents] == ["application/pdf"] * 3
+
+
+def test_queues_are_per_app():
+    """Test that the same document ID in another app's database is still queued"""
+    apps = [create_app({"TESTING": True, "DB_BACKEND": "sqlite"}) for _ in range(2)]
+    try:
+        document_ids = [
+            insert_document(app, b"%PDF-1.7 not really", "None") for app in apps
+        ]
+        assert document_ids[0] == document_ids[1]
+
+        futures = [
+            schedule_processing(app, "documents_buyer", document_id)
+            for app, document_id in zip(apps, document_ids)
+        ]
+        assert all(futures)
+        for future in futures:
+            future.result(timeout=5)
+        for app, document_id in zip(apps, document_ids):
+            assert get_document(app, document_id)["processing_status"] == "done"
+    finally:
+        for app in apps:
+            close_store(app)
+
+
+def test_close_store_stops_processing(app):
+    """Test that no processing job is left running once the store is closed"""
+    document_id = insert_document(app, b"%PDF-1.7 not really", "None")
+    future = schedule_processing(app, "documents_buyer", document_id)
+
+    close_store(app)
+
+    assert future.done()
+    assert "processing_queue" not in app.extensions
@@ -0,0 +1,186 @@
+import io
+import threading
+
+import pytest
+from flask import Flask, jsonify
+
+import rate_limit
+from rate_limit import RateLimiter, parse_rate_limits
+
+
+@pytest.fixture
+def limited_app():
+    """App with the real endpoint names and small limits, no database needed"""
+    app = Flask(__name__)
+    app.config["TESTING"] = True
+    limiter = RateLimiter(
+        {"query_documents": (1, 2)},
+        max_concurrent_requests=1,
+        max_inflight_upload_bytes=100,
+        max_subscribers=1,
+    )
+    rate_limit.init_app(app, limiter)
+
+    app.blocked = threading.Event()
+    app.entered = threading.Event()
+
+    @app.route("/documents", methods=["POST"])
+    def add_document():
+        if "block" in app.config:
+            app.entered.set()
+            app.blocked.wait(5)
+        return jsonify({"message": "ok"}), 201
+
+    @app.route("/documents/query", methods=["GET"])
+    def query_documents():
+        return jsonify({"count": 0, "documents": []})
+
+    @app.route("/documents/events/stream", methods=["GET"])
+    def stream_document_events():
+        def generate():
+            while True:
+                yield ": keep-alive\n\n"
+
+        return app.response_class(generate(), mimetype="text/event-stream")
+
+    return app
+
+
+def test_parse_rate_limits():
+    """Test parsing per route limits from the environment"""
+    assert parse_rate_limits("query_documents=20/50, add_document=0.5/2") == {
+        "query_documents": (20.0, 50.0),
+        "add_document": (0.5, 2.0),
+    }
+    assert parse_rate_limits("") == {}
+    with pytest.raises(ValueError):
+        parse_rate_limits("query_documents=0/5")
+    with pytest.raises(ValueError):
+        parse_rate_limits("query_documents=1/0")
+
+
+def test_new_client_gets_its_burst(limited_app):
+    """Test that a burst of 1 lets a new client's first request through"""
+    limited_app.extensions["rate_limiter"].rate_limits["query_documents"] = (1, 1)
+    client = limited_app.test_client()
+    assert client.get("/documents/query").status_code == 200
+    assert client.get("/documents/query").status_code == 429
+
+
+def test_upload_without_content_length(limited_app):
+    """Test that a chunked upload of unknown size is refused before it is read"""
+    client = limited_app.test_client()
+    response = client.post(
+        "/documents",
+        input_stream=io.BytesIO(b"x" * 10),
+        headers={"Transfer-Encoding": "chunked"},
+    )
+    assert response.status_code == 411
+
+
+def test_rate_limit_per_client(limited_app):
+    """Test that a client is limited after its burst and others are not"""
+    client = limited_app.test_client()
+    assert client.get("/documents/query").status_code == 200
+    assert client.get("/documents/query").status_code == 200
+
+    response = client.get("/documents/query")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+    # Headers the client controls don't give it a new bucket
+    response = client.get(
+        "/documents/query",
+        headers={"X-Client-Id": "listing", "X-Forwarded-For": "10.0.0.9"},
+    )
+    assert response.status_code == 429
+
+    response = client.get("/documents/query", environ_base={"REMOTE_ADDR": "10.0.0.2"})
+    assert response.status_code == 200
+
+    metrics = client.get("/metrics/rate_limits").get_json()
+    assert metrics["counters"]["rate_limited"] == 2
+    assert metrics["counters"]["allowed"] == 3
+
+
+def test_upload_too_large(limited_app):
+    """Test that an upload larger than the in-flight byte cap is refused"""
+    client = limited_app.test_client()
+    data = {"file": (io.BytesIO(b"x" * 200), "big.pdf", "application/pdf")}
+    response = client.post("/documents", data=data, content_type="multipart/form-data")
+    assert response.status_code == 413
+
+
+def test_overload_sheds_load(limited_app):
+    """Test that requests are shed with a 503 while the service is saturated"""
+    limited_app.config["block"] = True
+    client = limited_app.test_client()
+
+    thread = threading.Thread(target=lambda: client.post("/documents", data=b"x"))
+    thread.start()
+    assert limited_app.entered.wait(5)
+
+    response = limited_app.test_client().get("/documents/query")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+    limited_app.blocked.set()
+    thread.join()
+
+    # The slot is released once the blocked request finishes
+    assert limited_app.test_client().get("/documents/query").status_code == 200
+    metrics = limited_app.test_client().get("/metrics/rate_limits").get_json()
+    assert metrics["concurrent_requests"] == 0
+    assert metrics["counters"]["shed_concurrency"] == 1
+
+
+def test_subscribers_are_capped(limited_app):
+    """Test that open event streams are capped and released on disconnect"""
+    client = limited_app.test_client()
+    stream = client.get("/documents/events/stream")
+    assert stream.status_code == 200
+    next(stream.response)
+
+    # The stream is still open, so the only subscriber slot is taken
+    response = limited_app.test_client().get(
+        "/documents/events/stream", environ_base={"REMOTE_ADDR": "10.0.0.2"}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+    # Subscribers don't take the slots of ordinary requests
+    assert client.get("/documents/query").status_code == 200
+
+    stream.close()
+    metrics = client.get("/metrics/rate_limits").get_json()
+    assert metrics["subscribers"] == 0
+    assert metrics["counters"]["shed_subscribers"] == 1
+
+
+def test_subscribers_are_capped_per_client(limited_app):
+    """Test that one client can't take every subscriber slot"""
+    limiter = limited_app.extensions["rate_limiter"]
+    limiter.max_subscribers = 2
+    limiter.max_subscribers_per_client = 1
+
+    client = limited_app.test_client()
+    stream = client.get("/documents/events/stream")
+    assert stream.status_code == 200
+    next(stream.response)
+
+    response = client.get("/documents/events/stream")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+    # Another client still gets the remaining slot
+    other = limited_app.test_client().get(
+        "/documents/events/stream", environ_base={"REMOTE_ADDR": "10.0.0.2"}
+    )
+    assert other.status_code == 200
+    other.close()
+
+    stream.close()
+    metrics = client.get("/metrics/rate_limits").get_json()
+    assert metrics["subscribers"] == 0
+    assert metrics["counters"]["shed_client_subscribers"] == 1
+    assert limiter.client_subscribers == {}